@@ -2,71 +2,185 @@
 
 """Script for converting PDF to Markdown via OpenAI's `gpt-4o` model."""
 
-import backoff
-import base64
+import aiofiles
+import asyncio
+import binascii
+import httpx
+import mimetypes
+import multiprocessing
 import os
+import pypdfium2 as pdfium
+import random
+import sqlite3
 import sys
+import xxhash
 
-from contextlib import closing
+from aiolimiter import AsyncLimiter
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor
+)
+from contextlib import (
+    AsyncExitStack,
+    closing,
+    nullcontext
+)
+from functools import partial
 from getpass import getpass
-from io import BytesIO
+from itertools import (
+    chain,
+    count
+)
 from openai import (
-    OpenAI,
+    AsyncOpenAI,
     RateLimitError
 )
 from pathlib import Path
-from pdf2image import convert_from_path
-from PIL import Image
+from tempfile import (
+    NamedTemporaryFile,
+    TemporaryDirectory
+)
 from tqdm import tqdm
 
-# fallback to prompting user for OpenAI API key if not set in environment
-api_key = os.environ.get('OPENAI_API_KEY') or getpass(prompt='OpenAI API key:')
+try:
+    # SIMD accelerated base64 encoding
+    from pybase64 import b64encode_as_string
+except ImportError:
+    def b64encode_as_string(data):
+        """Base64 encode the given bytes-like object as a string"""
+        return binascii.b2a_base64(data, newline=False).decode('ascii')
 
-openai = OpenAI(api_key=api_key)
+try:
+    # libjpeg-turbo's SIMD accelerated JPEG encoder
+    import numpy as np
+    from turbojpeg import (
+        TJPF_RGB,
+        TJSAMP_420,
+        TurboJPEG
+    )
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG or the libjpeg-turbo library itself isn't installed
+    turbo_jpeg = None
 
-@backoff.on_exception(backoff.expo, RateLimitError)
-def completions_with_backoff(**kwargs):
-    """OpenAI chat completions wrapper that will retry with a backoff strategy when encountering API rate limits"""
-    return openai.chat.completions.create(**kwargs)
+def openai_client(concurrency=8):
+    """Create an OpenAI API client that can keep `concurrency` requests in flight at once
 
-def page_image2md(page_image):
-    """Prompt OpenAI `gpt-4o` model to generate Markdown text from given PIL.Image"""
-    # encode image with base64 url encoding in order to pass it to the OpenAI API
-    with BytesIO() as buffer:
-        page_image.save(buffer, format=page_image.format)
-        url_encoded_image = (
-            f'data:image/{page_image.format.lower()};'
-            f'base64,{base64.b64encode(buffer.getvalue()).decode("utf8")}'
-        )
-    # get completions from OpenAI API
-    response = completions_with_backoff(
-        model="gpt-4o",
+    Requests are multiplexed over HTTP/2 connections from a connection pool sized for the concurrency,
+    so concurrent pages don't queue up waiting for connections (or TLS handshakes).
+    """
+    # fallback to prompting user for OpenAI API key if not set in environment
+    api_key = os.environ.get('OPENAI_API_KEY') or getpass(prompt='OpenAI API key:')
+    return AsyncOpenAI(
+        api_key=api_key,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(600.0, connect=30.0),
+            limits=httpx.Limits(
+                max_connections=concurrency * 2,
+                max_keepalive_connections=concurrency * 2,
+            ),
+        ),
+    )
+
+# OpenAI model used to convert page images to Markdown
+MODEL = 'gpt-4o'
+
+# maximum number of seconds to wait for the next chunk of a streamed completion before retrying it
+STREAM_IDLE_TIMEOUT = 60
+
+# maximum number of seconds to wait between retries when the API doesn't say how long to wait
+MAX_RETRY_DELAY = 60
+
+async def stream_completion(client, **kwargs):
+    """Stream an OpenAI chat completion and return its text once it is complete
+
+    If no chunk arrives for STREAM_IDLE_TIMEOUT seconds, an `asyncio.TimeoutError` is raised.
+    """
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    chunks = stream.__aiter__()
+    text = []
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), timeout=STREAM_IDLE_TIMEOUT)
+            except StopAsyncIteration:
+                break
+            if chunk.choices and chunk.choices[0].delta.content:
+                text.append(chunk.choices[0].delta.content)
+    finally:
+        await stream.response.aclose()
+    return ''.join(text)
+
+def retry_after(error):
+    """Get the number of seconds to wait before retrying, as given by the API in the given error's response (if any)"""
+    headers = error.response.headers
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass # e.g., an HTTP date rather than a number of seconds
+    return None
+
+async def completions_with_backoff(client, limiter=None, **kwargs):
+    """OpenAI chat completions wrapper that will retry with a backoff strategy when encountering API rate limits
+
+    Rate limited requests are retried after the delay the API asks for via its `Retry-After` header,
+    and stalled streams (see `stream_completion`) are retried with exponential backoff.
+    Retries are jittered so that concurrent requests don't retry in lockstep.
+    Requests are paced by the given `aiolimiter.AsyncLimiter` (if any).
+    """
+    for attempt in count():
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            return await stream_completion(client, **kwargs)
+        except RateLimitError as e:
+            delay = retry_after(e)
+        except asyncio.TimeoutError:
+            delay = None
+        if delay is None:
+            delay = min(2 ** attempt, MAX_RETRY_DELAY)
+        await asyncio.sleep(delay + random.uniform(0, 0.25))
+
+# prompt messages that are the same for every page, built once and shared by every request
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [
+        {
+            "type": "text",
+            "text": "You are a system that expertly extracts the contents of documents into textual representations as Markdown.",
+        },
+    ],
+}
+USER_PROMPT = {
+    "type": "text",
+    "text": (
+        "Convert the following image of a page from a PDF document to Markdown.  "
+        "Include all headings, paragraphs, lists, tables, etc.  "
+        "Ensure markup is included as necessary such as bold, italics, super- or sub-scripts, etc.  "
+        "Include additional notation as necessary such as mathematical notation in LaTeX math mode, code in pre-formatted blocks, etc.  "
+        "The output should be Markdown itself (don't preformat the output in a markdown block), and exclude local or hyperlinked images.  "
+        "I.e., don't include a block like ```markdown ...``` wrapping the entire page (unless the entire page's content is actually Markdown source).  "
+    )
+}
+
+async def page_url2md(url_encoded_image, client, limiter=None):
+    """Prompt OpenAI `gpt-4o` model to generate Markdown text from given base64 data URL encoded image"""
+    markdown = await completions_with_backoff(
+        client,
+        limiter=limiter,
+        model=MODEL,
         seed=0,
         temperature=0.0,
         messages=[
-            {
-                "role": "system",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "You are a system that expertly extracts the contents of documents into textual representations as Markdown.",
-                    },
-                ],
-            },
+            SYSTEM_MESSAGE,
             {
                 "role": "user",
                 "content": [
-                    {
-                        "type": "text",
-                        "text": (
-                            "Convert the following image of a page from a PDF document to Markdown.  "
-                            "Include all headings, paragraphs, lists, tables, etc.  "
-                            "Ensure markup is included as necessary such as bold, italics, super- or sub-scripts, etc.  "
-                            "Include additional notation as necessary such as mathematical notation in LaTeX math mode, code in pre-formatted blocks, etc.  "
-                            "The output should be Markdown itself (don't preformat the output in a markdown block), and exclude local or hyperlinked images.  "
-                            "I.e., don't include a block like ```markdown ...``` wrapping the entire page (unless the entire page's content is actually Markdown source).  "
-                        )
-                    },
+                    USER_PROMPT,
                     {
                         "type": "image_url",
                         "image_url": {
@@ -78,69 +192,418 @@ def page_image2md(page_image):
         ],
         max_tokens=16384, # current maximum token limit
     )
-    return response
+    return markdown
+
+# size of the chunks that are base64 encoded at a time (a multiple of 3 bytes, so chunks encode independently)
+BASE64_CHUNK_SIZE = 57 * 1024
+
+def data_url(mime, fp):
+    """Encode the contents of the given binary file object as a base64 data URL with the given MIME type
+
+    The file is read and encoded chunk by chunk through a single reused buffer,
+    so its contents never sit in memory as a whole.
+    """
+    chunks = [f'data:{mime};base64,']
+    buffer = bytearray(BASE64_CHUNK_SIZE)
+    with memoryview(buffer) as view:
+        # buffered reads only come up short at the end of the file, so every other chunk is a multiple of 3 bytes
+        while size := fp.readinto(buffer):
+            chunks.append(b64encode_as_string(view[:size]))
+    return ''.join(chunks)
+
+def save_page_image(page_image, fp, image_format='JPEG', jpeg_quality=85):
+    """Save the given PIL.Image to the given file object in the given image format
+
+    Images are saved as JPEG by default, which is much cheaper to encode and upload than PNG.
+    JPEGs are encoded by libjpeg-turbo in a single call when PyTurboJPEG is available.
+    """
+    if image_format.upper() == 'JPEG' and turbo_jpeg is not None:
+        fp.write(turbo_jpeg.encode(
+            np.asarray(page_image.convert('RGB')),
+            quality=jpeg_quality,
+            pixel_format=TJPF_RGB,
+            jpeg_subsample=TJSAMP_420,
+        ))
+    elif image_format.upper() == 'JPEG':
+        page_image.convert('RGB').save(
+            fp,
+            format='JPEG',
+            quality=jpeg_quality,
+            optimize=False,
+            progressive=False,
+        )
+    else:
+        page_image.save(fp, format=image_format)
+
+# number of pages rendered by each page rendering worker process at a time
+PAGES_PER_RENDER_JOB = 4
+
+# file extensions of page image files by image format
+PAGE_IMAGE_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+}
+
+def page_image_path(folder, pdf_path, page_number, page_image_format='JPEG'):
+    """Get the path of the image file of the given page of the given PDF file in the given folder
+
+    Page image files are named after the PDF file and the page number, e.g., `example.pdf-0001.jpg`.
+    """
+    extension = PAGE_IMAGE_EXTENSIONS.get(page_image_format.upper(), page_image_format.lower())
+    return Path(folder) / f'{pdf_path.name}-{page_number:04d}.{extension}'
+
+def render_pages(
+    pdf_path,
+    output_folder,
+    page_numbers,
+    page_dpi=200,
+    page_image_format='JPEG',
+    jpeg_quality=85,
+    max_edge=1540,
+):
+    """Render the given pages of the given PDF file to image files and return their paths.
+
+    Pages are rendered at page_dpi, or lower such that no edge is longer than max_edge pixels
+    (unless max_edge is None), since larger images only cost more to upload without improving results.
+    Each page image file is written to a temporary file that is then moved into place,
+    so an interrupted run can't leave a truncated page image behind.
+    """
+    paths = []
+    with closing(pdfium.PdfDocument(pdf_path)) as pdf:
+        for page_number in page_numbers:
+            page = pdf[page_number - 1]
+            # PDF user space is 72 units per inch
+            scale = page_dpi / 72
+            longest_edge = max(page.get_size())
+            if max_edge and longest_edge * scale > max_edge:
+                scale = max_edge / longest_edge
+            page_image = page.render(scale=scale).to_pil()
+            path = page_image_path(output_folder, pdf_path, page_number, page_image_format=page_image_format)
+            with NamedTemporaryFile(dir=output_folder, suffix='.tmp', delete=False) as image_file:
+                save_page_image(page_image, image_file, image_format=page_image_format, jpeg_quality=jpeg_quality)
+            # any data URL cached for a previous image of this page is stale now
+            path.with_suffix('.b64').unlink(missing_ok=True)
+            os.replace(image_file.name, path)
+            paths.append(path)
+    return paths
+
+def will_need(path):
+    """Hint to the OS that the given file will be read soon so it can be read ahead into the page cache
+
+    This is a no-op on platforms without `posix_fadvise` (e.g., macOS or Windows).
+    """
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
 
-def get_page_images(
+def get_page_paths(
     pdf_path,
     cache_pages=False,
     first_page=None,
     last_page=None,
     page_dpi=200,
-    page_image_format='PNG',
+    page_image_format='JPEG',
+    jpeg_quality=85,
+    max_edge=1540,
+    readahead=8,
+    output_folder=None,
+    page_count=None,
 ):
-    """Generate PIL.Images for each page of the given PDF file.
+    """Generate paths to image files for each page of the given PDF file.
 
     PDF page images can be cached to avoid regenerating them for every run.
-    A range of pages can also be specified via the {first,last}_page keyword paramaters.
-    The resolution of the images can be specified in dots-per-inch (DPI) via the page_dpi.
+    Otherwise, they are rendered to output_folder (by default, a temporary directory that is removed
+    as soon as the generator is done, so callers that read pages later should pass their own).
+    Cached pages are read ahead a window of `readahead` pages at a time.
+    A range of pages can also be specified via the {first,last}_page keyword paramaters
+    (out of page_count pages, which is counted here unless the caller already has).
+    The resolution of the images can be specified in dots-per-inch (DPI) via the page_dpi,
+    and capped to at most max_edge pixels on their longest edge.
+    JPEG page images are saved with the given jpeg_quality.
+
+    Cached page images are only reused for pages that have them; any other pages are rendered (and cached).
+    Pages are rendered in-process by PDFium, in parallel in blocks of PAGES_PER_RENDER_JOB pages
+    by a pool of worker processes (PDFium itself isn't thread-safe),
+    and images are generated in page order as soon as each block is done rendering.
     """
     pdf_pages_cache_directory = pdf_path.with_suffix('')
-    if cache_pages and pdf_pages_cache_directory.is_dir():
-        for path in sorted(pdf_pages_cache_directory.glob(f'*.{page_image_format.lower()}')):
-            path = Path(path)
-            if path.is_file():
-                with Image.open(path) as image:
-                    yield image
-    else:
-        if cache_pages:
-            pdf_pages_cache_directory.mkdir(parents=True, exist_ok=True)
-        yield from convert_from_path(
-            pdf_path,
-            first_page=first_page,
-            last_page=last_page,
-            output_folder=(pdf_pages_cache_directory if cache_pages else None),
-            output_file=pdf_path,
-            dpi=page_dpi,
-            fmt=page_image_format,
-            thread_count=8,
-        )
+    if page_count is None:
+        with closing(pdfium.PdfDocument(pdf_path)) as pdf:
+            page_count = len(pdf)
+    first_page = max(first_page or 1, 1)
+    last_page = min(last_page or page_count, page_count)
+    page_numbers = range(first_page, last_page + 1)
+    if cache_pages:
+        output_folder = pdf_pages_cache_directory
+        output_folder.mkdir(parents=True, exist_ok=True)
+    output_folder_context = nullcontext(output_folder) if output_folder is not None else TemporaryDirectory()
+    with output_folder_context as output_folder:
+        paths = [
+            page_image_path(output_folder, pdf_path, page_number, page_image_format=page_image_format)
+            for page_number in page_numbers
+        ]
+        # render any pages that aren't cached yet (e.g., by an older version or an interrupted run)
+        cached = [cache_pages and path.is_file() for path in paths]
+        uncached_page_numbers = [
+            page_number for page_number, is_cached in zip(page_numbers, cached) if not is_cached
+        ]
+        with ProcessPoolExecutor(
+            max_workers=max((os.cpu_count() or 1) - 1, 1),
+            # forking a process that is running threads (e.g., an event loop's executor) can deadlock
+            mp_context=multiprocessing.get_context('spawn'),
+        ) as executor:
+            try:
+                rendered_paths = chain.from_iterable(executor.map(
+                    partial(
+                        render_pages,
+                        pdf_path,
+                        output_folder,
+                        page_dpi=page_dpi,
+                        page_image_format=page_image_format,
+                        jpeg_quality=jpeg_quality,
+                        max_edge=max_edge,
+                    ),
+                    (
+                        uncached_page_numbers[i:i + PAGES_PER_RENDER_JOB]
+                        for i in range(0, len(uncached_page_numbers), PAGES_PER_RENDER_JOB)
+                    ),
+                ))
+                # number of pages read ahead so far
+                hinted = 0
+                for i, (path, is_cached) in enumerate(zip(paths, cached)):
+                    # slide the read ahead window over the pages, reading ahead the cached ones
+                    # (preferring the data URLs cached alongside page images)
+                    for upcoming, upcoming_is_cached in zip(
+                        paths[hinted:i + readahead],
+                        cached[hinted:i + readahead],
+                    ):
+                        if upcoming_is_cached:
+                            data_url_path = upcoming.with_suffix('.b64')
+                            will_need(data_url_path if data_url_path.is_file() else upcoming)
+                    hinted = i + readahead
+                    yield path if is_cached else next(rendered_paths)
+            finally:
+                # don't render the rest of the pages when the generator is closed early
+                executor.shutdown(cancel_futures=True)
+
+def page_data_url(path, cache_pages=False):
+    """Get the base64 data URL of the given page image file
+
+    When caching pages, the data URL is also cached alongside the page image in a `.b64` file,
+    so re-runs neither read nor encode the page image again.
+    """
+    data_url_path = path.with_suffix('.b64')
+    if cache_pages and data_url_path.is_file():
+        return data_url_path.read_text()
+    mime, _ = mimetypes.guess_type(path)
+    with open(path, 'rb') as image_file:
+        url_encoded_image = data_url(mime, image_file)
+    if cache_pages:
+        # write to a temporary file that is then moved into place,
+        # so an interrupted run can't leave a truncated data URL behind
+        with NamedTemporaryFile('w', dir=path.parent, suffix='.tmp', delete=False) as temporary_file:
+            temporary_file.write(url_encoded_image)
+        os.replace(temporary_file.name, data_url_path)
+    return url_encoded_image
+
+class MarkdownMemo:
+    """SQLite database of the Markdown previously generated for page images
+
+    Pages are keyed by the model and a hash of their page image file,
+    so identical pages (e.g., blank pages or separator pages) are only ever converted once.
+    """
+
+    def __init__(self, path, model=MODEL):
+        self.model = model
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'hash TEXT NOT NULL, model TEXT NOT NULL, md TEXT NOT NULL, PRIMARY KEY (hash, model))'
+            )
 
-def main(
+    @staticmethod
+    def key(path):
+        """Hash the contents of the given page image file, a chunk at a time"""
+        page_hash = xxhash.xxh3_64()
+        with open(path, 'rb') as image_file:
+            for chunk in iter(partial(image_file.read, BASE64_CHUNK_SIZE), b''):
+                page_hash.update(chunk)
+        return page_hash.hexdigest()
+
+    def get(self, key):
+        """Get the Markdown memoized for the given page image hash (or None)"""
+        row = self.connection.execute(
+            'SELECT md FROM pages WHERE hash=? AND model=?',
+            (key, self.model),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, markdown):
+        """Memoize the Markdown generated for the given page image hash"""
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO pages (hash, model, md) VALUES (?, ?, ?)',
+                (key, self.model, markdown),
+            )
+
+    def close(self):
+        self.connection.close()
+
+# number of converted pages to buffer before writing them to a (non-interactive) output file
+PAGES_PER_WRITE = 8
+
+async def main(
     pdf_path,
     cache_pages=False,
     first_page=None,
     last_page=None,
     page_dpi=200,
-    page_image_format='PNG',
-    output_file=sys.stdout,
+    page_image_format='JPEG',
+    jpeg_quality=85,
+    max_edge=1540,
+    concurrency=8,
+    requests_per_minute=None,
+    memo_path=None,
+    output_path=None,
     page_sep=('\n' * 3) + ('-' * 10) + ('\n' * 3),
 ):
-    with closing(output_file) as md_file:
-        with tqdm(
-            get_page_images(
-                pdf_path,
-                cache_pages=cache_pages,
-                first_page=first_page,
-                last_page=last_page,
-                page_dpi=page_dpi,
-                page_image_format=page_image_format,
-            ),
-            unit='page',
-        ) as images:
-            for image in images:
-                completions = page_image2md(image)
-                markdown = completions.choices[0].message.content
-                print(markdown, file=md_file, flush=True, end=page_sep)
+    """Convert the given PDF file to Markdown, page by page, and write the Markdown to output_path (or stdout).
+
+    Up to `concurrency` pages are converted at once; a new page is started as soon as any page is done,
+    while pages are still written out in order.
+    Writes to output_path are asynchronous so they don't block conversions in progress.
+    Requests can be limited to at most `requests_per_minute` to stay within the account's rate limits.
+    Markdown for each page can be memoized in a SQLite database at memo_path to skip converting identical pages again.
+    """
+    # enough threads to encode every page in flight alongside the thread reading pages
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency + 1))
+    semaphore = asyncio.Semaphore(concurrency)
+    # one request at a time, evenly spaced, so that fractional rates (e.g., 0.5 per minute) work too
+    limiter = AsyncLimiter(1, 60 / requests_per_minute) if requests_per_minute else None
+    # conversion tasks in page order, terminated by None
+    tasks = asyncio.Queue()
+    # conversion tasks that aren't done yet
+    pending = set()
+
+    # memoized conversions in flight by page image hash, so identical pages in flight share one request
+    in_flight = {}
+
+    async def convert_page(path):
+        # encode each page in its own thread, so pages in flight are encoded in parallel
+        url_encoded_image = await asyncio.to_thread(page_data_url, path, cache_pages=cache_pages)
+        return await page_url2md(url_encoded_image, client, limiter=limiter)
+
+    async def convert_and_memoize_page(key, path):
+        try:
+            markdown = await convert_page(path)
+            memo.put(key, markdown)
+            return markdown
+        finally:
+            del in_flight[key]
+
+    async def convert(path):
+        try:
+            if memo is None:
+                return await convert_page(path)
+            key = await asyncio.to_thread(MarkdownMemo.key, path)
+            markdown = memo.get(key)
+            if markdown is None:
+                if key not in in_flight:
+                    in_flight[key] = asyncio.create_task(convert_and_memoize_page(key, path))
+                markdown = await asyncio.shield(in_flight[key])
+            return markdown
+        finally:
+            semaphore.release()
+
+    async def produce():
+        pages = get_page_paths(
+            pdf_path,
+            cache_pages=cache_pages,
+            first_page=first_page,
+            last_page=last_page,
+            page_dpi=page_dpi,
+            page_image_format=page_image_format,
+            jpeg_quality=jpeg_quality,
+            max_edge=max_edge,
+            readahead=concurrency,
+            output_folder=pages_directory,
+            page_count=page_count,
+        )
+        try:
+            while True:
+                await semaphore.acquire()
+                # read pages in a thread so that rendering doesn't block conversions in progress
+                next_page = asyncio.ensure_future(asyncio.to_thread(next, pages, None))
+                try:
+                    page = await asyncio.shield(next_page)
+                except asyncio.CancelledError:
+                    # the page generator can't be closed until it is done reading the page in the thread
+                    await asyncio.wait([next_page])
+                    raise
+                if page is None:
+                    semaphore.release()
+                    break
+                task = asyncio.create_task(convert(page))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                await tasks.put(task)
+        finally:
+            await asyncio.to_thread(pages.close)
+            # always end the queue, so the consumer stops (and awaits the producer's error) if reading pages fails
+            tasks.put_nowait(None)
+
+    # open the PDF up front, so a missing or invalid PDF fails before the pipeline starts
+    with closing(pdfium.PdfDocument(pdf_path)) as pdf:
+        page_count = len(pdf)
+    async with AsyncExitStack() as stack:
+        # open the output file before prompting for an API key, so a bad output path fails fast too
+        md_file = None
+        if output_path is not None:
+            md_file = await stack.enter_async_context(
+                aiofiles.open(output_path, 'w', buffering=1024 * 1024)
+            )
+        memo = stack.enter_context(closing(MarkdownMemo(memo_path))) if memo_path else None
+        # uncached pages are rendered to a temporary directory that outlives the conversions reading them
+        pages_directory = stack.enter_context(TemporaryDirectory())
+        client = await stack.enter_async_context(openai_client(concurrency))
+
+        async def write(text):
+            if md_file is None:
+                # writes to stdout are kept synchronous
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            else:
+                await md_file.write(text)
+                await md_file.flush()
+
+        # write pages out as they're done when watching a terminal, otherwise in batches of pages
+        pages_per_write = 1 if md_file is None and sys.stdout.isatty() else PAGES_PER_WRITE
+        producer = asyncio.create_task(produce())
+        try:
+            write_buffer = []
+            with tqdm(unit='page') as progress:
+                try:
+                    while (task := await tasks.get()) is not None:
+                        write_buffer.append(await task)
+                        write_buffer.append(page_sep)
+                        progress.update()
+                        if len(write_buffer) >= 2 * pages_per_write:
+                            await write(''.join(write_buffer))
+                            write_buffer.clear()
+                finally:
+                    await write(''.join(write_buffer))
+            await producer
+        finally:
+            # stop reading pages and converting them (e.g., if a page failed or on KeyboardInterrupt)
+            producer.cancel()
+            unfinished = (*pending, *in_flight.values())
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(producer, *unfinished, return_exceptions=True)
 
 if __name__ == '__main__':
     import argparse
@@ -156,9 +619,9 @@ if __name__ == '__main__':
     parser.add_argument(
         'output',
         nargs='?',
-        type=argparse.FileType('w'),
-        default=sys.stdout,
-        help='output file where Markdown conversion will be written (or stdout)',
+        type=Path,
+        default=None,
+        help="output file where Markdown conversion will be written (or stdout, also given as '-')",
     )
     parser.add_argument(
         '-c', '--cache-pages',
@@ -184,12 +647,55 @@ if __name__ == '__main__':
         default=200,
         help='intermediate image resolution in dots-per-inch (DPI) (higher DPI is higher quality, but takes more memory/disk space)',
     )
+    parser.add_argument(
+        '--jpeg-quality',
+        type=int,
+        default=85,
+        help='JPEG quality (1-95) of intermediate page images (higher quality is larger to upload)',
+    )
+    parser.add_argument(
+        '--max-edge',
+        type=int,
+        default=1540,
+        help='maximum length in pixels of the longest edge of intermediate page images (0 for no maximum)',
+    )
+    parser.add_argument(
+        '-j', '--concurrency',
+        type=int,
+        default=8,
+        help='maximum number of pages to convert at once',
+    )
+    parser.add_argument(
+        '-m', '--memo',
+        type=Path,
+        default=None,
+        help='SQLite database where the Markdown of each page is memoized, so identical pages are only converted once',
+    )
+    parser.add_argument(
+        '--requests-per-minute',
+        type=float,
+        default=None,
+        help="maximum number of OpenAI API requests to make per minute (e.g., your account's rate limit)",
+    )
     args = parser.parse_args()
-    main(
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if not 1 <= args.jpeg_quality <= 95:
+        parser.error('--jpeg-quality must be between 1 and 95')
+    if args.max_edge < 0:
+        parser.error('--max-edge must not be negative')
+    if args.requests_per_minute is not None and args.requests_per_minute <= 0:
+        parser.error('--requests-per-minute must be positive')
+    asyncio.run(main(
         args.pdf,
         cache_pages=args.cache_pages,
         first_page=args.first_page,
         last_page=args.last_page,
         page_dpi=args.dpi,
-        output_file=args.output,
-    )
+        jpeg_quality=args.jpeg_quality,
+        max_edge=args.max_edge,
+        concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
+        memo_path=args.memo,
+        output_path=None if args.output == Path('-') else args.output,
+    ))